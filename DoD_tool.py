@@ -11,26 +11,63 @@ Purpose:
 - Isolate erosion signals
 - Estimate erosion volume using zonal statistics
 
+The raster algebra (Steps 1-5) runs in a single Numba kernel on tiles read
+with rasterio, spread over worker processes. The zonal statistics and
+volume (Steps 6-7) are reduced in NumPy and written as a CSV table, so
+ArcGIS is no longer required.
+
 Author: Charles Ghartey
 Generated: 2024-07-05
 """
 
-import arcpy
-from arcpy.sa import *     # Spatial Analyst tools
-from arcpy.ia import *     # Image Analyst tools
+import csv
+import os
+import warnings
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import ExitStack
+from itertools import islice
+import numpy as np
+import rasterio
+from numba import njit
+from rasterio.enums import MaskFlags
+from rasterio.windows import Window
 from sys import argv
 
 
+# NoData values written to the float and zone (uint8) output rasters
+NODATA = -9999.0
+ZONE_NODATA = 255
+
+# Edge length (cells) of the tiles the DoD is computed in
+TILE_SIZE = 1024
+
+# Zones of the erosion mask and the sign of the DoD in each
+# (0 = deposition, 1 = erosion)
+ZONE_SIGNS = {0: 1, 1: -1}
+
+# The zonal histograms count the absolute filtered DoD in millimetres,
+# saturating at the int16 range (32.767 m)
+MM_PER_M = 1000
+MM_LIMIT = np.iinfo(np.int16).max
+
+# Tile buffers of the current (worker) process, reused across tiles
+_BUFFERS = {}
+
+# DEM datasets opened by the current (worker) process, keyed by path
+_DATASETS = {}
+
+
 def DoDfin(
     dem_later="August_2019.tif",
     dem_earlier="May_2019.tif",
     mLoD=0.2,
-    dod_raw="Aug_May2019",
-    dod_threshold_mask="thres2019",
-    dod_reclass="Reclass_thre2019",
-    dod_thresholded="thres_fin2019",
-    erosion_mask="ero2019",
-    erosion_stats="ZonalSt_ero2019"
+    dod_raw=None,
+    dod_threshold_mask=None,
+    dod_reclass=None,
+    dod_thresholded="thres_fin2019.tif",
+    erosion_mask="ero2019.tif",
+    erosion_stats="ZonalSt_ero2019.csv",
+    save_intermediates=False
 ):
     """
     Computes a thresholded Difference of DEMs (DoD) and estimates erosion volume.
@@ -43,86 +80,338 @@ def DoDfin(
         Earlier DEM (e.g., May 2019)
     mLoD : float
         Minimum Level of Detection (vertical uncertainty threshold, meters)
+    dod_raw, dod_threshold_mask, dod_reclass : str
+        Ignored. These rasters are no longer produced; the parameters are
+        kept so existing positional calls (and ``argv``) keep their order.
+    erosion_stats : str
+        CSV table with COUNT, AREA, MEDIAN and Volume per erosion zone
+    save_intermediates : bool
+        Also write the thresholded DoD and erosion mask rasters to
+        ``dod_thresholded`` and ``erosion_mask``.
     """
-
-    # Allow overwriting outputs if rerunning
-    arcpy.env.overwriteOutput = True
-
-    # Check out required licenses
-    arcpy.CheckOutExtension("Spatial")
-    arcpy.CheckOutExtension("ImageAnalyst")
-    arcpy.CheckOutExtension("3D")
+    mLoD = float(mLoD)
+    if isinstance(save_intermediates, str):
+        save_intermediates = save_intermediates.lower() == "true"
 
     # ------------------------------------------------------------------
-    # Step 1: Compute raw DoD (Later DEM - Earlier DEM)
+    # Steps 0-5: Thresholded DoD and erosion mask, per tile
     # ------------------------------------------------------------------
-    dod = Raster(dem_later) - Raster(dem_earlier)
-    dod.save(dod_raw)
+    cell_area, zone_hists, saturated = _dod_zone_hists(
+        dem_later, dem_earlier, mLoD,
+        (dod_thresholded, erosion_mask) if save_intermediates else None
+    )
+    if saturated:
+        warnings.warn(
+            f"{saturated} cells change by more than {MM_LIMIT / MM_PER_M} m "
+            f"and are clamped to that value in the zonal histograms"
+        )
 
     # ------------------------------------------------------------------
-    # Step 2: Apply minimum Level of Detection (mLoD)
-    # Retain only cells exceeding ±mLoD
+    # Step 6: Zonal statistics for erosion (count and median per zone)
+    # Step 7: Compute erosion volume (Area × Median elevation change)
     # ------------------------------------------------------------------
-    dod_mask = (dod > float(mLoD)) | (dod < -float(mLoD))
-    dod_mask.save(dod_threshold_mask)
+    with open(erosion_stats, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["Value", "COUNT", "AREA", "MEDIAN", "Volume"])
+        for zone, sign in ZONE_SIGNS.items():
+            hist = zone_hists[zone]
+            count = int(hist.sum())
+            area = count * cell_area
+            median = float("nan")
+            if count:
+                median_mm = _histogram_median(hist)
+                if median_mm >= MM_LIMIT:
+                    raise ValueError(
+                        f"Median change of zone {zone} exceeds the "
+                        f"±{MM_LIMIT / MM_PER_M} m histogram range"
+                    )
+                median = sign * median_mm / MM_PER_M
+            writer.writerow([zone, count, area, median, area * median])
 
-    # ------------------------------------------------------------------
-    # Step 3: Reclassify threshold mask to binary (1 = significant change)
-    # ------------------------------------------------------------------
-    dod_binary = Reclassify(
-        dod_mask,
-        "Value",
-        RemapValue([[0, "NODATA"], [1, 1]])
-    )
-    dod_binary.save(dod_reclass)
 
-    # ------------------------------------------------------------------
-    # Step 4: Apply threshold mask to DoD
-    # Removes changes below detection limit
-    # ------------------------------------------------------------------
-    dod_filtered = dod_binary * dod
-    dod_filtered.save(dod_thresholded)
+def _dod_zone_hists(dem_later, dem_earlier, mLoD, rasters=None):
+    """
+    Runs Steps 0-5 over the overlap of both DEMs.
 
-    # ------------------------------------------------------------------
-    # Step 5: Identify erosion cells (negative elevation change)
-    # ------------------------------------------------------------------
-    erosion = Con(dod_filtered < 0, 1, 0)
-    erosion.save(erosion_mask)
+    ``rasters`` is an optional ``(dod_thresholded, erosion_mask)`` pair of
+    paths the tile products are written to. Returns the area of one cell
+    in squared map units, per zone, the histogram of the absolute filtered
+    DoD in millimetres and the number of cells clamped in the histograms.
+    """
+    with rasterio.open(dem_later) as src_later, \
+            rasterio.open(dem_earlier) as src_earlier:
+        # --------------------------------------------------------------
+        # Step 0: Restrict processing to the overlap of both DEMs
+        # Cells outside the intersection are NoData in the DoD anyway
+        # --------------------------------------------------------------
+        win_later, win_earlier = _overlap_windows(src_later, src_earlier)
 
-    # ------------------------------------------------------------------
-    # Step 6: Zonal statistics for erosion
-    # Used to compute erosion volume
-    # ------------------------------------------------------------------
-    arcpy.ia.ZonalStatisticsAsTable(
-        in_zone_data=erosion,
-        zone_field="Value",
-        in_value_raster=dod_filtered,
-        out_table=erosion_stats,
-        ignore_nodata="DATA",
-        statistics_type="ALL"
-    )
+        profile = src_later.profile
+        profile.update(
+            driver="GTiff",
+            count=1,
+            width=win_later.width,
+            height=win_later.height,
+            transform=src_later.window_transform(win_later)
+        )
 
     # ------------------------------------------------------------------
-    # Step 7: Compute erosion volume (Area × Median elevation change)
+    # Steps 1-5 run tile by tile in worker processes; each tile's
+    # products are collected (and optionally written) here
     # ------------------------------------------------------------------
-    arcpy.management.AddField(
-        in_table=erosion_stats,
-        field_name="Volume",
-        field_type="DOUBLE"
-    )
+    tiles = _tile_windows(win_later.height, win_later.width)
+    zone_hists = np.zeros((len(ZONE_SIGNS), MM_LIMIT + 1), dtype=np.int64)
+    saturated = 0
 
-    arcpy.management.CalculateField(
-        in_table=erosion_stats,
-        field="Volume",
-        expression="!AREA! * !MEDIAN!",
-        expression_type="PYTHON3"
-    )
+    with ExitStack() as stack:
+        dsts = []
+        if rasters is not None:
+            outputs = zip(rasters, [("float32", NODATA), ("uint8", ZONE_NODATA)])
+            dsts = [
+                stack.enter_context(rasterio.open(
+                    path, "w", **dict(profile, dtype=dtype, nodata=nodata)))
+                for path, (dtype, nodata) in outputs
+            ]
+        # A couple of tiles per worker are in flight at a time and each
+        # future is dropped once consumed, so finished tiles (and their
+        # rasters) are not kept alive until all tiles are done
+        max_pending = 2 * (os.cpu_count() or 1)
+        pending = set()
+        tiles = iter(tiles)
+        with ProcessPoolExecutor() as executor:
+            while True:
+                for tile in islice(tiles, max_pending - len(pending)):
+                    pending.add(executor.submit(
+                        _dod_tile, dem_later, dem_earlier, win_later,
+                        win_earlier, tile, mLoD, rasters is not None))
+                if not pending:
+                    break
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    tile, arrays, hists, tile_saturated = future.result()
+                    for dst, array in zip(dsts, arrays):
+                        dst.write(array, 1, window=tile)
+                    zone_hists += hists
+                    saturated += tile_saturated
+
+    cell_area = abs(profile["transform"].a * profile["transform"].e)
+    return cell_area, zone_hists, saturated
+
+
+def _histogram_median(hist):
+    """
+    Returns the median of the values counted in ``hist`` (value = index),
+    averaging the two middle values for an even count like ``np.median``.
+    """
+    cumulative = np.cumsum(hist)
+    count = cumulative[-1]
+    lower = np.searchsorted(cumulative, (count - 1) // 2, side="right")
+    upper = np.searchsorted(cumulative, count // 2, side="right")
+    return (lower + upper) / 2
+
+
+def _overlap_windows(src_later, src_earlier):
+    """
+    Returns the windows of both DEMs covering their common extent.
+
+    Both DEMs must share the same CRS and cell size, and their grids must
+    be aligned (origins a whole number of cells apart); the windows have
+    identical shapes so the arrays read through them can be combined cell
+    by cell. Resample one DEM onto the other's grid beforehand otherwise.
+    """
+    if src_later.crs != src_earlier.crs:
+        raise ValueError(
+            f"DEM CRS differ: {src_later.crs} vs {src_earlier.crs}"
+        )
+    if not np.allclose(src_later.res, src_earlier.res):
+        raise ValueError(
+            f"DEM cell sizes differ: {src_later.res} vs {src_earlier.res}"
+        )
+    shift = np.array([
+        (src_later.transform.c - src_earlier.transform.c) / src_later.res[0],
+        (src_later.transform.f - src_earlier.transform.f) / src_later.res[1],
+    ])
+    if not np.allclose(shift, np.round(shift), atol=1e-6):
+        raise ValueError(
+            f"DEM grids are not aligned: origins differ by {shift} cells"
+        )
+
+    # Whole-cell offset of the earlier grid origin in the later grid;
+    # rounding the validated shift avoids flooring float offsets such as
+    # 99.9999999 to 99, which would misregister the DEMs by one cell
+    col_shift, row_shift = (int(v) for v in np.rint(shift * [-1, 1]))
+    col_off = max(0, col_shift)
+    row_off = max(0, row_shift)
+    width = min(src_later.width, col_shift + src_earlier.width) - col_off
+    height = min(src_later.height, row_shift + src_earlier.height) - row_off
+    if width <= 0 or height <= 0:
+        raise ValueError(f"{src_later.name} and {src_earlier.name} do not overlap")
+
+    return (Window(col_off, row_off, width, height),
+            Window(col_off - col_shift, row_off - row_shift, width, height))
+
+
+def _tile_windows(height, width, size=TILE_SIZE):
+    """
+    Splits a ``height`` x ``width`` grid into square tiles of ``size`` cells.
+
+    Tiles on the right and bottom edges are clipped to the grid.
+    """
+    return [
+        Window(col, row, min(size, width - col), min(size, height - row))
+        for row in range(0, height, size)
+        for col in range(0, width, size)
+    ]
+
+
+def _dod_tile(dem_later, dem_earlier, win_later, win_earlier, tile, mLoD,
+              return_rasters=False):
+    """
+    Computes Steps 1-5 of the DoD workflow for one tile of the overlap.
+
+    ``tile`` is relative to the overlap windows. The DEMs are opened once
+    per process (see ``_dataset``) so tiles can run in separate worker
+    processes without reopening them for every tile. Returns the tile,
+    the filtered DoD and erosion mask arrays (empty unless
+    ``return_rasters``), per zone (row), the histogram of the absolute
+    filtered DoD in millimetres and the number of cells clamped in the
+    histograms.
+    """
+    later, earlier, dod_filtered, erosion, mask, hists = _tile_buffers(
+        tile.height, tile.width)
+
+    nodata_later = _read_dem(_dataset(dem_later), _offset(win_later, tile),
+                             later, mask)
+    nodata_earlier = _read_dem(_dataset(dem_earlier),
+                               _offset(win_earlier, tile), earlier, mask)
+
+    saturated = _dod_kernel(later, earlier, nodata_later, nodata_earlier,
+                            np.float32(mLoD), hists, dod_filtered, erosion,
+                            return_rasters)
+
+    rasters = ()
+    if return_rasters:
+        rasters = (dod_filtered.copy(), erosion.copy())
+    # The worker pickles the result before taking the next tile, so the
+    # histogram buffer can be returned as is
+    return tile, rasters, hists, saturated
+
+
+def _dataset(path):
+    """
+    Returns the dataset of ``path`` opened for reading in this process.
+
+    The handle is opened on first use and kept for the life of the
+    (worker) process, so the GDAL open, header parse and mask band probe
+    happen once per worker rather than once per tile.
+    """
+    if path not in _DATASETS:
+        _DATASETS[path] = rasterio.open(path)
+    return _DATASETS[path]
+
+
+def _read_dem(src, window, out, mask):
+    """
+    Reads band 1 of ``src`` through ``window`` into the float32 ``out``
+    and returns the NoData value the kernel has to match (NaN if the DEM
+    has none).
+
+    Cells invalidated by a mask that is not derived from the NoData value
+    (internal or ``.msk`` mask band, alpha band) are set to NaN, using
+    ``mask`` as the uint8 buffer for the mask band.
+    """
+    src.read(1, window=window, out=out, out_dtype=np.float32)
+    flags = src.mask_flag_enums[0]
+    if MaskFlags.per_dataset in flags or MaskFlags.alpha in flags:
+        src.read_masks(1, window=window, out=mask)
+        out[mask == 0] = np.nan
+    return np.float32(np.nan if src.nodata is None else src.nodata)
+
+
+def _tile_buffers(height, width):
+    """
+    Returns the later DEM, earlier DEM, filtered DoD, erosion mask and
+    mask band arrays for a ``height`` x ``width`` tile, and the zeroed
+    per zone millimetre histograms.
+
+    The arrays are contiguous views on buffers allocated once per process
+    and only grown if a larger tile comes along, so consecutive tiles in
+    a worker reuse the same memory instead of reallocating it.
+    """
+    size = height * width
+    if _BUFFERS.get("size", 0) < size:
+        size_alloc = max(size, TILE_SIZE * TILE_SIZE)
+        _BUFFERS["size"] = size_alloc
+        _BUFFERS["later"] = np.empty(size_alloc, dtype=np.float32)
+        _BUFFERS["earlier"] = np.empty(size_alloc, dtype=np.float32)
+        _BUFFERS["dod_filtered"] = np.empty(size_alloc, dtype=np.float32)
+        _BUFFERS["erosion"] = np.empty(size_alloc, dtype=np.uint8)
+        _BUFFERS["mask"] = np.empty(size_alloc, dtype=np.uint8)
+        _BUFFERS["hists"] = np.empty((len(ZONE_SIGNS), MM_LIMIT + 1),
+                                     dtype=np.int64)
+    _BUFFERS["hists"].fill(0)
+    return tuple(_BUFFERS[name][:size].reshape(height, width)
+                 for name in ("later", "earlier", "dod_filtered", "erosion",
+                              "mask")) + (_BUFFERS["hists"],)
+
+
+@njit(cache=True)
+def _dod_kernel(later, earlier, nodata_later, nodata_earlier, mlod,
+                hists, dod_filtered, erosion, write_rasters):
+    """
+    Fused Steps 1-5: one pass over both DEMs thresholds the DoD at ±mLoD
+    and counts each significant change in the millimetre histogram of its
+    zone (row of ``hists``), plus, if ``write_rasters``, fills the float32
+    filtered DoD (NODATA elsewhere) and the uint8 erosion mask
+    (ZONE_NODATA elsewhere), without materializing the intermediate
+    rasters. Returns the number of significant cells whose millimetre
+    value was clamped.
+
+    The threshold and the float output use the unquantized difference.
+    Only the histogram bins are quantized: rounded to the millimetre, at
+    least 1 mm so sub-millimetre significant changes stay counted, and
+    saturating at MM_LIMIT. Every cell adds 0 or 1 to a bin, so the loop
+    only uses conditional selects.
+
+    The kernel is serial: tiles already run in a process pool with one
+    worker per core, and a Numba thread pool in every worker would
+    oversubscribe the CPU.
+    """
+    zero = np.float32(0)
+    nodata = np.float32(NODATA)
+    limit = np.float32(MM_LIMIT)
+    saturated = 0
+    for i in range(later.shape[0]):
+        for j in range(later.shape[1]):
+            # Step 1: raw DoD (Later DEM - Earlier DEM), NoData as 0
+            a = later[i, j]
+            b = earlier[i, j]
+            d = a - b
+            valid = (d == d) & (a != nodata_later) & (b != nodata_earlier)
+            d = d if valid else zero
+            # Steps 2-4: keep only changes exceeding ±mLoD
+            significant = valid & (abs(d) > mlod)
+            # Step 5: erosion cells are the negative significant changes
+            zone = 1 if d < 0 else 0
+            if write_rasters:
+                dod_filtered[i, j] = d if significant else nodata
+                erosion[i, j] = zone if significant else ZONE_NODATA
+            # Millimetre bin of the zonal histograms
+            q = max(np.rint(abs(d) * np.float32(MM_PER_M)), np.float32(1))
+            saturated += 1 if significant & (q > limit) else 0
+            hists[zone, np.intp(min(q, limit))] += 1 if significant else 0
+    return saturated
+
+
+def _offset(window, tile):
+    """
+    Shifts ``tile`` by the offsets of ``window``.
+    """
+    return Window(window.col_off + tile.col_off, window.row_off + tile.row_off,
+                  tile.width, tile.height)
 
 
 if __name__ == "__main__":
     # Workspace environment
-    with arcpy.EnvManager(
-        workspace=r"Y:\GHARTEY\AkyemData\Backup\August_All_min\DOD_fin_arc\Default.gdb",
-        scratchWorkspace=r"Y:\GHARTEY\AkyemData\Backup\August_All_min\DOD_fin_arc\Default.gdb"
-    ):
-        DoDfin(*argv[1:])
+    os.chdir(r"Y:\GHARTEY\AkyemData\Backup\August_All_min\DOD_fin_arc")
+    DoDfin(*argv[1:])
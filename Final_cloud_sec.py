@@ -2,19 +2,20 @@
 program for # This program performs the following tasks:
 # 1. Imports necessary libraries including os, numpy, cloudComPy, open3d, and time.
 # 2. Defines functions to:
-#    - Load data from LAS files, including initializing cloudComPy, loading point cloud data,
-#      getting global shift coordinates, loading segmentation boundary polyline, and loading cross-sectional polyline.
+#    - Load data from LAS files, including initializing cloudComPy, caching point cloud data as BIN,
+#      getting global shift coordinates, and loading the cross-sectional polyline.
 #    - Generate ortho sections based on a cross-sectional polyline, step, width, and vertical direction.
 #    - Extract ortho and cloud sections from a point cloud based on provided parameters.
-#    - Save ortho and cloud sections to files in LAS and text formats.
+#    - Save ortho and cloud sections to files in LAZ format (and optionally text).
 #    - Visualize cross-sections using Open3D.
 #    - Measure the processing time of the main function.
 # 3. Implements the main function which:
-#    - Specifies the directory containing LAS files.
-#    - Loads data from LAS files using the load_data function.
-#    - Prompts the user for input regarding ortho section parameters.
-#    - Generates ortho sections, extracts sections, creates output directories,
-#      saves sections, and visualizes cross-sections for each LAS file.
+#    - Reads the LAS directory and ortho section parameters from the command line,
+#      prompting once for any parameter not given.
+#    - Caches the LAS files as BIN clouds in parallel.
+#    - Creates output directories, then generates ortho sections, extracts sections
+#      and saves sections for all LAS files in parallel worker processes.
+#    - Visualizes the saved cross-sections of each LAS file.
 #    - Prints the total processing time upon completion.
 # 4. Runs the main function if the script is executed as the main program.
 
@@ -22,44 +23,88 @@ program for # This program performs the following tasks:
 @author:Charles Ghartey
 """
 # Import necessary libraries
+import argparse
 import os
 import numpy as np
 import cloudComPy as cc  
 import open3d as o3d
 import time  
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
-# Function to load data
-def load_data(directory):
-    # Initialize cloudComPy
-    cc.initCC() 
+# Sections with more points than this are voxel down-sampled before display
+MAX_VIEW_POINTS = 5_000_000
+
+# Worker processes used by default; each one holds a whole cloud and its sections
+# in memory, so raise it only if RAM allows (see --workers)
+DEFAULT_WORKERS = 2
+
+# Polylines loaded by this process, keyed by (path, global shift)
+_POLYLINE_CACHE = {}
+
+# Whether cloudComPy has been initialized in this process
+_CC_READY = False
+
+# Function to initialize cloudComPy once per process (also used as pool initializer)
+def _init_cc():
+    global _CC_READY
+    if not _CC_READY:
+        cc.initCC()
+        _CC_READY = True
+
+# Function to convert a LAS file to a BIN cache once and reuse it while the LAS file is unchanged
+def _ensure_binary_cache(las_path):
+    cloud_path = las_path + ".bin"
+    # Sidecar file holding the LAS (mtime, size) key and the global shift of the cache
+    key_path = cloud_path + ".key"
+    stat = os.stat(las_path)
+    key = f"{stat.st_mtime_ns} {stat.st_size}"
+    # Reuse the cache if it was written for the current LAS file
+    if os.path.exists(cloud_path) and os.path.exists(key_path):
+        with open(key_path) as f:
+            lines = f.read().splitlines()
+        if len(lines) == 2 and lines[0] == key:
+            return cloud_path, tuple(float(v) for v in lines[1].split())
+    # Load point cloud data
+    cloud = cc.loadPointCloud(las_path)
+    # Get global shift coordinates
+    shift = tuple(cc.ccShiftedObject.getGlobalShift(cloud))
+    # Save as BIN (fast to reload, keeps name and global shift)
+    cc.SavePointCloud(cloud, cloud_path)
+    # Write the key last so an interrupted save is never taken as a valid cache
+    with open(key_path, "w") as f:
+        f.write(f"{key}\n{shift[0]!r} {shift[1]!r} {shift[2]!r}\n")
+    return cloud_path, shift
+
+# Function to load one LAS file in a worker process
+def _load_one(las_path):
+    # Initialize cloudComPy in this worker process, unless the pool initializer did
+    _init_cc()
+    # cloudComPy objects cannot be sent back to the main process, so return
+    # the path of the BIN cache and its global shift instead
+    return _ensure_binary_cache(las_path)
+
+# Function to load a polyline, reusing an already loaded one for the same global shift
+def _load_polyline(path, shift, cache):
+    # DXF polylines only differ between clouds by the global shift applied on load
+    key = (path, tuple(shift))
+    if key not in cache:
+        x, y, z = shift
+        cache[key] = cc.loadPolyline(path, mode=cc.CC_SHIFT_MODE.XYZ, x=x, y=y, z=z)
+    return cache[key]
+
+# Function to cache the LAS files of a directory as BIN clouds
+def _cache_clouds(directory):
     # Get list of files in the specified directory
     files = os.listdir(directory)
     # Filter LAS files
     las_files = [file for file in files if file.endswith(".las")]
-    # Initialize empty lists to store data
-    clouds, polys, cross_polylines = [], [], []
-    # Iterate over LAS files
-    for las_file in las_files:
-        # Load point cloud data
-        cloud = cc.loadPointCloud(os.path.join(directory, las_file))
-        print(f"Cloud name: {cloud.getName()} for file {las_file}")
-        # Get global shift coordinates
-        x, y, z = cc.ccShiftedObject.getGlobalShift(cloud)
-        print(f"Coordinates of shift: ({x}, {y}, {z})")
-        # Load segmentation boundary polyline
-        poly = cc.loadPolyline(os.path.join(directory, "polyline.dxf"),
-                               mode=cc.CC_SHIFT_MODE.XYZ, x=x, y=y, z=z)
-        print(f"Segmentation boundary: {poly.getName()} for file {las_file}")
-        poly.setClosed(True)
-        polys.append(poly)
-        # Load cross-sectional polyline
-        cross_polyline = cc.loadPolyline(os.path.join(directory, "north1.dxf"),
-                                         mode=cc.CC_SHIFT_MODE.XYZ, x=x, y=y, z=z)
-        cross_polyline.setClosed(False)
-        cross_polylines.append(cross_polyline)
-        clouds.append(cloud)
-
-    return clouds, polys, cross_polylines
+    # Decode new or changed LAS files in parallel, one worker process per core
+    # (a decode worker only holds the cloud it converts, unlike the section workers)
+    las_paths = [os.path.join(directory, las_file) for las_file in las_files]
+    with ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=_init_cc) as executor:
+        results = list(executor.map(_load_one, las_paths))
+    return las_files, results
 
 # Function to generate ortho sections
 def generate_ortho_sections(cross_polyline, step, width, vertical_direction):
@@ -69,19 +114,36 @@ def generate_ortho_sections(cross_polyline, step, width, vertical_direction):
 
 # Function to extract sections from the point cloud
 def extract_sections(cloud, cross_polyline, orthoPolys, default_section_thickness):
-    # Extract ortho and cloud sections from the point cloud
+    # Extract ortho sections from the point cloud
     orthoSections = cc.extractPointsAlongSections([cloud], orthoPolys,
                                                   defaultSectionThickness=default_section_thickness,
                                                   extractSectionsAsClouds=True,
                                                   extractSectionsAsEnvelopes=False)
+    # Extract the cloud section along the cross-sectional polyline
     cloudSections = cc.extractPointsAlongSections([cloud], [cross_polyline],
                                                   defaultSectionThickness=default_section_thickness,
                                                   extractSectionsAsClouds=True,
                                                   extractSectionsAsEnvelopes=False)
     return orthoSections, cloudSections
 
+# Function to save a section to a text file straight from its NumPy arrays, with the columns
+# of cc's ASCII writer: global X Y Z, then R G B (if colored), then each scalar field
+def _save_txt(section, txt_path):
+    shift = cc.ccShiftedObject.getGlobalShift(section)
+    columns = [cc.ccPointCloud.toNpArray(section).astype(np.float64) - shift]
+    fmt = ["%.8f"] * 3
+    if section.hasColors():
+        columns.append(section.colorsToNpArray()[:, :3])
+        fmt += ["%d"] * 3
+    for j in range(section.getNumberOfScalarFields()):
+        columns.append(section.getScalarField(j).toNpArray()[:, None])
+        fmt.append("%.8f")
+    np.savetxt(txt_path, np.column_stack(columns), fmt=fmt)
+
 # Function to save sections to files
-def save_sections(orthoSections, orthoOutputDir, cloudSections, cloudOutputDir, file_name):
+def save_sections(orthoSections, orthoOutputDir, cloudSections, cloudOutputDir, file_name, also_txt=False):
+    # Paths of the saved cloud sections
+    cloud_paths = []
     # Save ortho sections
     for i, section in enumerate(orthoSections):
         file_path = os.path.join(orthoOutputDir, f"{file_name}_ortho_section_{i}.laz")
@@ -90,70 +152,142 @@ def save_sections(orthoSections, orthoOutputDir, cloudSections, cloudOutputDir,
     # Save cloud sections
     for i, section in enumerate(cloudSections):
         file_path = os.path.join(cloudOutputDir, f"{file_name}_cloud_section_{i}.laz")
-        xyz_path = os.path.join(cloudOutputDir, f"{file_name}_cloud_section_{i}.txt")
         cc.SavePointCloud(section, file_path)
-        # Save point cloud data to a text file
-        cc.SavePointCloud(section, xyz_path)
+        cloud_paths.append(file_path)
+        if also_txt:
+            xyz_path = os.path.join(cloudOutputDir, f"{file_name}_cloud_section_{i}.txt")
+            _save_txt(section, xyz_path)
+    return cloud_paths
        
 # Function to visualize cross-sections
-def visualize_cross_sections(cloudSections, default_section_thickness):
+def visualize_cross_sections(cloudSections, default_section_thickness, voxel_size=0.05):
+    # Float64 buffer reused across sections, grown only for a larger section
+    buffer = np.empty((0, 3), dtype=np.float64)
     for i, section in enumerate(cloudSections):
-        # Convert ccPointCloud to NumPy array
+        # Wrap the ccPointCloud coordinates as a NumPy array (no copy)
         points = cc.ccPointCloud.toNpArray(section)
         
-        # Create Open3D point cloud object
-        pcd = o3d.geometry.PointCloud()
-        pcd.points = o3d.utility.Vector3dVector(points)
-        
         # Get the number of points in the point cloud
         num_points = len(points)
         
+        # Widen the float32 coordinates to the float64 Open3D stores, in a single copy
+        if num_points > len(buffer):
+            buffer = np.empty((num_points, 3), dtype=np.float64)
+        points64 = buffer[:num_points]
+        np.copyto(points64, points)
+        
+        # Create Open3D point cloud object
+        pcd = o3d.geometry.PointCloud()
+        pcd.points = o3d.utility.Vector3dVector(points64)
+        
         # Print the description of the section
         print(f"Visualizing cross-section {i+1} with {num_points} points.")
         
+        # Thin out very large sections, the viewer cannot render them interactively
+        if num_points > MAX_VIEW_POINTS:
+            pcd = pcd.voxel_down_sample(voxel_size=voxel_size)
+            print(f"Down-sampled to {len(pcd.points)} points with voxel size {voxel_size}m.")
+        
         # Visualize the point cloud using Open3D
         o3d.visualization.draw_geometries([pcd], 
                                            window_name=f"Cross-section slice {i+1} with slice thickness {default_section_thickness}m ",
                                            width=700, height=700)
 
+# Function to extract and save the sections of one cached cloud in a worker process
+def _process_one(cloud_path, shift, directory, orthoOutputDir, cloudOutputDir, step, width,
+                 vertical_direction, default_section_thickness, also_txt=False):
+    # Initialize cloudComPy in this worker process, unless the pool initializer did
+    _init_cc()
+    x, y, z = shift
+    # Load the cached point cloud with its global shift
+    cloud = cc.loadPointCloud(cloud_path, mode=cc.CC_SHIFT_MODE.XYZ, x=x, y=y, z=z)
+    print(f"Cloud name: {cloud.getName()}")
+    print(f"Coordinates of shift: ({x}, {y}, {z})")
+    # Load cross-sectional polyline
+    cross_polyline = _load_polyline(os.path.join(directory, "north1.dxf"), shift, _POLYLINE_CACHE)
+    cross_polyline.setClosed(False)
+    
+    # Generate ortho sections
+    orthoPolys = generate_ortho_sections(cross_polyline, step, width, vertical_direction)
+    
+    # Extract sections
+    orthoSections, cloudSections = extract_sections(cloud, cross_polyline, orthoPolys, default_section_thickness)
+    
+    # Get the base name of the LAS file
+    file_name = os.path.splitext(os.path.basename(cloud.getName()))[0]
+    
+    # Save sections and return the cloud section paths for visualization
+    return save_sections(orthoSections, orthoOutputDir, cloudSections, cloudOutputDir, file_name, also_txt)
+
+# Function to read the command line arguments
+def parse_args():
+    parser = argparse.ArgumentParser(description="Extract cross-sections from LAS point clouds.")
+    parser.add_argument("--directory", default=r"D:\CE_666\Final",
+                        help="directory containing the LAS files, polyline.dxf and north1.dxf")
+    parser.add_argument("--step", type=float, help="step for ortho sections")
+    parser.add_argument("--width", type=float, help="width for ortho sections")
+    parser.add_argument("--vdir", type=int, choices=[0, 1, 2],
+                        help="vertical direction for ortho sections (0 (oX), 1 (oY), 2 (oZ))")
+    parser.add_argument("--thickness", type=float, help="default section thickness")
+    parser.add_argument("--txt", action="store_true", help="also save cloud sections as text files")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                        help="number of worker processes; each holds a whole cloud in memory "
+                             f"(default: {DEFAULT_WORKERS})")
+    args = parser.parse_args()
+    
+    # User input, once, for ortho section parameters missing from the command line
+    if args.step is None:
+        args.step = float(input("Enter the step for ortho sections: "))
+    if args.width is None:
+        args.width = float(input("Enter the width for ortho sections: "))
+    if args.vdir is None:
+        args.vdir = int(input("Enter the vertical direction for ortho sections (O (oX), 1, (oY), 2 (oZ)): "))
+        if args.vdir not in (0, 1, 2):
+            parser.error(f"vertical direction must be 0, 1 or 2, not {args.vdir}")
+    if args.thickness is None:
+        args.thickness = float(input("Enter the default section thickness: "))
+    if args.workers < 1:
+        parser.error(f"--workers must be at least 1, not {args.workers}")
+    return args
+
 # Main function
 def main():
+    # Read the ortho section parameters before any processing starts
+    args = parse_args()
+    
     # Start measuring processing time
     start_time = time.time()
     
-    # Specify the directory containing LAS files
-    directory = r"D:\CE_666\Final"
+    # Directory containing LAS files
+    directory = args.directory
+    
+    # Initialize cloudComPy
+    _init_cc()
     
-    # Load data
-    clouds, polys, cross_polylines = load_data(directory)
+    # Cache the LAS files as BIN clouds
+    las_files, results = _cache_clouds(directory)
     
-    for cloud, poly, cross_polyline in zip(clouds, polys, cross_polylines):
-        # User input for ortho section parameters
-        step = float(input("Enter the step for ortho sections: "))
-        width = float(input("Enter the width for ortho sections: "))
-        vertical_direction = int(input("Enter the vertical direction for ortho sections (O (oX), 1, (oY), 2 (oZ)): "))
-        default_section_thickness = float(input("Enter the default section thickness: "))
-        
-        # Generate ortho sections
-        orthoPolys = generate_ortho_sections(cross_polyline, step, width, vertical_direction)
-       
-        # Extract sections
-        orthoSections, cloudSections = extract_sections(cloud, cross_polyline, orthoPolys, default_section_thickness)
-       
-        # Create output directories
-        orthoOutputDir = os.path.join(directory, "ortho_sections")
-        cloudOutputDir = os.path.join(directory, "cloud_sections")
-        os.makedirs(orthoOutputDir, exist_ok=True)
-        os.makedirs(cloudOutputDir, exist_ok=True)
-        
-        # Get the base name of the LAS file
-        file_name = os.path.splitext(os.path.basename(cloud.getName()))[0]
-       
-        # Save sections
-        save_sections(orthoSections, orthoOutputDir, cloudSections, cloudOutputDir, file_name)
-       
-        # Visualize cross-sections
-        visualize_cross_sections(cloudSections, default_section_thickness)
+    # Create output directories
+    orthoOutputDir = os.path.join(directory, "ortho_sections")
+    cloudOutputDir = os.path.join(directory, "cloud_sections")
+    os.makedirs(orthoOutputDir, exist_ok=True)
+    os.makedirs(cloudOutputDir, exist_ok=True)
+    
+    # Extract and save the sections of all clouds back-to-back in worker processes
+    process = partial(_process_one, directory=directory,
+                      orthoOutputDir=orthoOutputDir, cloudOutputDir=cloudOutputDir,
+                      step=args.step, width=args.width, vertical_direction=args.vdir,
+                      default_section_thickness=args.thickness, also_txt=args.txt)
+    cloud_paths = [cloud_path for cloud_path, shift in results]
+    shifts = [shift for cloud_path, shift in results]
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_cc) as executor:
+        section_paths = list(executor.map(process, cloud_paths, shifts))
+    
+    # Visualize cross-sections
+    for las_file, paths in zip(las_files, section_paths):
+        print(f"Cross-sections for file {las_file}")
+        cloudSections = [cc.loadPointCloud(path) for path in paths]
+        visualize_cross_sections(cloudSections, args.thickness)
     
     # End measuring processing time
     end_time = time.time()
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+Checks the zonal statistics of DoDfin (int16 millimetre histograms) against
+a plain float32 DoD reduced with np.median, on small synthetic DEMs.
+"""
+
+import csv
+import math
+
+import numpy as np
+import pytest
+
+rasterio = pytest.importorskip("rasterio")
+pytest.importorskip("numba")
+from rasterio.transform import from_origin
+
+import DoD_tool
+
+
+NODATA = -9999.0
+CELL = 0.5
+
+
+def _write_dem(path, array, mask=None, transform=None):
+    profile = dict(
+        driver="GTiff",
+        width=array.shape[1],
+        height=array.shape[0],
+        count=1,
+        dtype="float32",
+        crs="EPSG:32630",
+        transform=transform or from_origin(1000.0, 2000.0, CELL, CELL),
+        nodata=NODATA
+    )
+    with rasterio.open(path, "w", **profile) as dst:
+        dst.write(array.astype(np.float32), 1)
+        if mask is not None:
+            dst.write_mask(mask)
+
+
+def _reference(later, earlier, mLoD):
+    """
+    COUNT, MEDIAN and Volume per zone from the unquantized float32 DoD.
+    """
+    later = later.astype(np.float32)
+    earlier = earlier.astype(np.float32)
+    dod = later - earlier
+    valid = (later != NODATA) & (earlier != NODATA)
+    significant = valid & (np.abs(dod) > np.float32(mLoD))
+    rows = {}
+    for zone, values in ((0, dod[significant & (dod > 0)]),
+                         (1, dod[significant & (dod < 0)])):
+        median = float(np.median(values)) if values.size else float("nan")
+        rows[zone] = (values.size, median, values.size * CELL ** 2 * median)
+    return rows
+
+
+def _run(tmp_path, later, earlier, mLoD):
+    _write_dem(tmp_path / "later.tif", later)
+    _write_dem(tmp_path / "earlier.tif", earlier)
+    stats = tmp_path / "stats.csv"
+    DoD_tool.DoDfin(str(tmp_path / "later.tif"), str(tmp_path / "earlier.tif"),
+                    mLoD, erosion_stats=str(stats))
+    with open(stats, newline="") as f:
+        return {int(row["Value"]): row for row in csv.DictReader(f)}
+
+
+def _check(rows, reference):
+    for zone, (count, median, volume) in reference.items():
+        row = rows[zone]
+        assert int(row["COUNT"]) == count
+        assert float(row["AREA"]) == pytest.approx(count * CELL ** 2)
+        if not count:
+            assert math.isnan(float(row["MEDIAN"]))
+            continue
+        # The histogram median is exact to the (rounded) millimetre
+        assert float(row["MEDIAN"]) == pytest.approx(median, abs=5e-4)
+        assert float(row["Volume"]) == pytest.approx(
+            volume, abs=count * CELL ** 2 * 5e-4)
+
+
+def test_random_dems_across_tiles(tmp_path):
+    rng = np.random.default_rng(0)
+    # Wider than TILE_SIZE so the overlap is split into several tiles
+    shape = (40, DoD_tool.TILE_SIZE + 100)
+    earlier = 250 + rng.normal(0, 5, shape)
+    later = earlier + rng.uniform(-2, 2, shape)
+    earlier[rng.random(shape) < 0.05] = NODATA
+    later[rng.random(shape) < 0.05] = NODATA
+
+    _check(_run(tmp_path, later, earlier, 0.2), _reference(later, earlier, 0.2))
+
+
+def test_even_counts_threshold_edges_and_nodata(tmp_path):
+    earlier = np.full((3, 4), 10.0)
+    later = earlier + np.array([
+        # Exactly ±mLoD is not significant
+        [0.25, -0.25, -0.5, -1.0],
+        # Erosion: 4 cells, median between the two middle values
+        [-0.75, -2.0, 0.3, 1.5],
+        # NoData in either DEM, and an unchanged cell
+        [0.0, 0.0, 0.0, 0.6],
+    ])
+    later[2, 0] = NODATA
+    earlier[2, 1] = NODATA
+
+    rows = _run(tmp_path, later, earlier, 0.25)
+    _check(rows, _reference(later, earlier, 0.25))
+    assert int(rows[1]["COUNT"]) == 4
+    assert float(rows[1]["MEDIAN"]) == pytest.approx(-0.875, abs=1e-6)
+    assert int(rows[0]["COUNT"]) == 3
+
+
+def test_sub_millimetre_margin_above_mlod(tmp_path):
+    # 0.2 < |d| < 0.2005 would round to the 200 mm threshold
+    earlier = np.full((2, 3), 100.0)
+    later = earlier + np.array([
+        [0.2003, -0.2003, 0.2004],
+        [-0.2004, 0.1, -0.1],
+    ])
+
+    rows = _run(tmp_path, later, earlier, 0.2)
+    _check(rows, _reference(later, earlier, 0.2))
+    assert int(rows[0]["COUNT"]) == 2
+    assert int(rows[1]["COUNT"]) == 2
+
+
+def test_clamped_changes_warn(tmp_path):
+    earlier = np.full((1, 5), 100.0)
+    later = earlier + np.array([[40.0, 1.0, 2.0, 3.0, -1.0]])
+
+    with pytest.warns(UserWarning, match="clamped"):
+        rows = _run(tmp_path, later, earlier, 0.2)
+    assert int(rows[0]["COUNT"]) == 4
+    assert float(rows[0]["MEDIAN"]) == pytest.approx(2.5, abs=5e-4)
+
+
+def test_mask_band_is_honoured(tmp_path):
+    earlier = np.full((2, 3), 50.0)
+    later = earlier + np.array([
+        [1.0, 2.0, 3.0],
+        [-1.0, -2.0, -3.0],
+    ])
+    # Cells hidden by a mask band (not by NoData) must be ignored
+    mask = np.full(later.shape, 255, dtype=np.uint8)
+    mask[0, 2] = mask[1, 0] = 0
+    _write_dem(tmp_path / "later.tif", later, mask)
+    _write_dem(tmp_path / "earlier.tif", earlier)
+    stats = tmp_path / "stats.csv"
+    DoD_tool.DoDfin(str(tmp_path / "later.tif"), str(tmp_path / "earlier.tif"),
+                    0.2, erosion_stats=str(stats))
+    with open(stats, newline="") as f:
+        rows = {int(row["Value"]): row for row in csv.DictReader(f)}
+
+    assert int(rows[0]["COUNT"]) == 2
+    assert float(rows[0]["MEDIAN"]) == pytest.approx(1.5, abs=5e-4)
+    assert int(rows[1]["COUNT"]) == 2
+    assert float(rows[1]["MEDIAN"]) == pytest.approx(-2.5, abs=5e-4)
+
+
+def test_offset_grids_are_registered_to_the_cell(tmp_path):
+    # 0.1 m cells and a non-round origin, offset by just under a whole
+    # number of cells (within the alignment tolerance), so flooring the
+    # float window offsets would shift one DEM by a cell
+    cell = 0.1
+    x0, y0 = 612345.67, 5234567.89
+    rows, cols = np.mgrid[0:60, 0:80]
+    # Each cell encodes its position, so a one-cell shift changes the DoD
+    grid = (rows * 100 + cols).astype(np.float64)
+    earlier = grid[:50, :70]
+    later = grid[7:, 13:] + 0.5
+    _write_dem(tmp_path / "earlier.tif", earlier,
+               transform=from_origin(x0, y0, cell, cell))
+    _write_dem(tmp_path / "later.tif", later,
+               transform=from_origin(x0 + (13 - 5e-7) * cell,
+                                     y0 - (7 - 5e-7) * cell, cell, cell))
+
+    with rasterio.open(tmp_path / "later.tif") as src_later, \
+            rasterio.open(tmp_path / "earlier.tif") as src_earlier:
+        win_later, win_earlier = DoD_tool._overlap_windows(src_later,
+                                                           src_earlier)
+    assert (win_later.col_off, win_later.row_off) == (0, 0)
+    assert (win_earlier.col_off, win_earlier.row_off) == (13, 7)
+    assert (win_later.height, win_later.width) == (43, 57)
+    assert (win_earlier.height, win_earlier.width) == (43, 57)
+
+    stats = tmp_path / "stats.csv"
+    DoD_tool.DoDfin(str(tmp_path / "later.tif"), str(tmp_path / "earlier.tif"),
+                    0.2, erosion_stats=str(stats))
+    with open(stats, newline="") as f:
+        rows = {int(row["Value"]): row for row in csv.DictReader(f)}
+    assert int(rows[0]["COUNT"]) == 43 * 57
+    assert float(rows[0]["MEDIAN"]) == pytest.approx(0.5, abs=5e-4)
+    assert int(rows[1]["COUNT"]) == 0